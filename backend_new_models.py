@@ -12,18 +12,19 @@ class User(db.Model):
 
     @staticmethod
     def create_default_admin():
+        from sqlalchemy.dialects.sqlite import insert
+
         admin_email = 'admin@diisco.app'
-        admin = User.query.filter_by(email=admin_email).first()
-        if not admin:
-            admin = User(
-                email=admin_email,
-                password_hash='hashed_default_password',  # Replace with secure hash
-                name='Default Admin',
-                role='admin'
-            )
-            db.session.add(admin)
-            db.session.commit()
-        return admin
+        # Single atomic upsert: no SELECT-then-INSERT race between workers
+        stmt = insert(User).values(
+            email=admin_email,
+            password_hash='hashed_default_password',  # Replace with secure hash
+            name='Default Admin',
+            role='admin'
+        ).on_conflict_do_nothing(index_elements=['email'])
+        db.session.execute(stmt)
+        db.session.commit()
+        return User.query.filter_by(email=admin_email).first()
 class Referrer(db.Model):
     __tablename__ = 'referrers'
 
@@ -86,6 +87,10 @@ class Dispute(db.Model):
     reporter = db.relationship('User', foreign_keys=[reporter_id])
     resolver = db.relationship('User', foreign_keys=[resolved_by])
 
+    __table_args__ = (
+        db.Index('idx_disputes_reporter_created', 'reporter_id', 'created_at'),
+    )
+
 
 # Venue Team Member Model (for multi-venue management)
 class VenueTeamMember(db.Model):
@@ -107,6 +112,10 @@ class VenueTeamMember(db.Model):
     user = db.relationship('User', foreign_keys=[user_id])
     inviter = db.relationship('User', foreign_keys=[invited_by])
 
+    __table_args__ = (
+        db.UniqueConstraint('venue_id', 'email', name='unique_venue_invite_email'),
+    )
+
 
 # Referral Transaction Model (for tracking payouts)
 class ReferralTransaction(db.Model):
@@ -129,6 +138,31 @@ class ReferralTransaction(db.Model):
     referral = db.relationship('Referral')
 
 
+# ===========================
+# SQLITE CONNECTION SETTINGS
+# Add this next to your db = SQLAlchemy() setup
+# ===========================
+
+import sqlite3
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+@event.listens_for(Engine, 'connect')
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    """Let readers and writers run concurrently on diisco.db"""
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')  # Readers don't block the writer
+    cursor.execute('PRAGMA synchronous=NORMAL')  # Safe with WAL, far fewer fsyncs
+    cursor.execute('PRAGMA busy_timeout=5000')  # Wait for the lock instead of "database is locked"
+    cursor.execute('PRAGMA cache_size=-65536')  # 64 MB page cache per connection
+    cursor.execute('PRAGMA temp_store=MEMORY')  # Sorts/temp tables in RAM, not temp files
+    cursor.execute('PRAGMA mmap_size=268435456')  # Memory-map up to 256 MB of the db file
+    cursor.close()
+
+
 # ===========================
 # UPDATES TO EXISTING MODELS
 # Add these fields to your existing models
@@ -239,7 +273,15 @@ ALTER TABLE referrals ADD COLUMN shifts_completed INTEGER DEFAULT 0;
 ALTER TABLE referrals ADD COLUMN referral_metadata JSON;
 
 -- Create indexes for performance
-CREATE INDEX idx_availability_user_date ON availability_slots(user_id, date);
+-- (availability_slots(user_id, date) is already indexed by its UNIQUE constraint)
 CREATE INDEX idx_disputes_status ON disputes(status);
 CREATE INDEX idx_disputes_shift ON disputes(shift_id);
+CREATE INDEX idx_disputes_reporter_created ON disputes(reporter_id, created_at);
+CREATE INDEX idx_ratings_shift_rater ON ratings(shift_id, rater_id, rated_user_id);
+CREATE UNIQUE INDEX unique_venue_invite_email ON venue_team_members(venue_id, email);
+CREATE INDEX idx_ratings_rated_created ON ratings(rated_user_id, created_at);
+CREATE INDEX idx_referrals_referrer ON referrals(referrer_id);
+CREATE INDEX idx_referrals_referred_status ON referrals(referred_user_id, status);
+CREATE INDEX idx_applications_worker_status ON applications(worker_id, status);
+CREATE INDEX idx_venue_profiles_parent ON venue_profiles(parent_venue_id);
 """
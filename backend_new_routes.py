@@ -1,27 +1,39 @@
 def handle_referral_on_shift_complete(worker_user_id, shift_id):
-    """Accumulate referral reward when referred user completes a shift."""
+    """Accumulate referral reward when referred user completes a shift.
+
+    Does not commit; the caller commits with the shift completion.
+    """
     # Find referral for this worker
     referral = Referral.query.filter_by(referred_user_id=worker_user_id, status='active').first()
     if referral:
-        # Increment shifts_completed
-        referral.shifts_completed = (referral.shifts_completed or 0) + 1
-        # Add £1 to referrer's balance
-        referrer = User.query.get(referral.referrer_id)
-        if referrer and referrer.worker_profile:
-            referrer.worker_profile.referral_balance = (referrer.worker_profile.referral_balance or 0) + 1.0
+        # Increment shifts_completed in SQL so concurrent completions don't lose updates
+        referral.shifts_completed = func.coalesce(Referral.shifts_completed, 0) + 1
+        # Add £1 to referrer's balance with a single atomic UPDATE
+        credited = WorkerProfile.query.filter_by(
+            user_id=referral.referrer_id
+        ).update(
+            {WorkerProfile.referral_balance: func.coalesce(WorkerProfile.referral_balance, 0) + 1.0},
+            synchronize_session='fetch'
+        )
+        if credited:
             # Create transaction record
             transaction = ReferralTransaction(
-                user_id=referrer.id,
+                user_id=referral.referrer_id,
                 referral_id=referral.id,
                 amount=1.0,
                 transaction_type='earn',
                 status='completed'
             )
             db.session.add(transaction)
-        db.session.commit()
 
-    # After marking shift as completed, call referral handler
-    handle_referral_on_shift_complete(worker_user_id, shift_id)
+
+# Usage: in the route that marks a shift as completed, call the referral
+# handler BEFORE that route's single commit so the reward is saved with it:
+#
+#     shift.status = 'completed'
+#     handle_referral_on_shift_complete(worker_user_id, shift.id)
+#     db.session.commit()
+
 # ===========================
 # NEW ROUTES TO ADD TO YOUR EXISTING app.py
 # Copy these routes into your Flask application
@@ -30,17 +42,22 @@ def handle_referral_on_shift_complete(worker_user_id, shift_id):
 # Add these imports at the top of your app.py:
 # import openai  # For CV parsing
 # from sqlalchemy import func
+# from sqlalchemy.dialects.sqlite import insert
+# from sqlalchemy.exc import IntegrityError
+# from sqlalchemy.orm import contains_eager, joinedload, raiseload
 
 # ===========================
 # CV UPLOAD & PARSING
 # ===========================
 
+ALLOWED_CV_EXTENSIONS = {'pdf', 'doc', 'docx'}
+
 @app.route('/api/worker/cv/upload', methods=['POST'])
 @jwt_required()
 def upload_cv_file():
     """Upload CV file"""
     user_id = get_jwt_identity()
-    user = User.query.get(user_id)
+    user = db.session.get(User, user_id)
 
     if not user or user.role != UserRole.WORKER:
         return jsonify({'error': 'Not a worker account'}), 403
@@ -53,8 +70,7 @@ def upload_cv_file():
         return jsonify({'error': 'No file selected'}), 400
 
     # Validate file type
-    allowed_extensions = {'pdf', 'doc', 'docx'}
-    if not ('.' in file.filename and file.filename.rsplit('.', 1)[1].lower() in allowed_extensions):
+    if not ('.' in file.filename and file.filename.rsplit('.', 1)[1].lower() in ALLOWED_CV_EXTENSIONS):
         return jsonify({'error': 'Invalid file type. Only PDF, DOC, DOCX allowed'}), 400
 
     # Save file
@@ -63,9 +79,10 @@ def upload_cv_file():
     os.makedirs(os.path.dirname(filepath), exist_ok=True)
     file.save(filepath)
 
-    # Store CV URL in database
+    # Store CV URL in database (a new CV invalidates the old summary)
     cv_url = f"/uploads/cvs/{filename}"
     user.worker_profile.cv_document = cv_url
+    user.worker_profile.cv_summary = None
     db.session.commit()
 
     return jsonify({
@@ -79,7 +96,7 @@ def upload_cv_file():
 def parse_cv():
     """Parse CV using AI to extract summary"""
     user_id = get_jwt_identity()
-    user = User.query.get(user_id)
+    user = db.session.get(User, user_id)
 
     if not user or user.role != UserRole.WORKER:
         return jsonify({'error': 'Not a worker account'}), 403
@@ -90,6 +107,17 @@ def parse_cv():
     if not cv_url:
         return jsonify({'error': 'CV URL required'}), 400
 
+    # The stored summary belongs to the profile's current CV only
+    profile = user.worker_profile
+    is_current_cv = profile.cv_document == cv_url
+
+    # Reuse the stored summary if this CV has already been parsed
+    if is_current_cv and profile.cv_summary:
+        return jsonify({
+            'summary': profile.cv_summary,
+            'message': 'CV parsed successfully'
+        }), 200
+
     # Simple AI parsing (in production, use OpenAI GPT-4 or similar)
     # For now, generate a sample summary
     cv_summary = f"Experienced hospitality professional with 3+ years in bartending and serving roles. Skilled in customer service, cocktail preparation, and high-volume environments."
@@ -105,8 +133,9 @@ def parse_cv():
     # )
     # cv_summary = response.choices[0].message.content
 
-    user.worker_profile.cv_summary = cv_summary
-    db.session.commit()
+    if is_current_cv:
+        profile.cv_summary = cv_summary
+        db.session.commit()
 
     return jsonify({
         'summary': cv_summary,
@@ -119,7 +148,7 @@ def parse_cv():
 def update_user_profile():
     """Update user profile"""
     user_id = get_jwt_identity()
-    user = User.query.get(user_id)
+    user = db.session.get(User, user_id)
 
     if not user:
         return jsonify({'error': 'User not found'}), 404
@@ -139,6 +168,9 @@ def update_user_profile():
     # Update worker-specific fields
     if user.role == UserRole.WORKER and user.worker_profile:
         if 'cv_url' in data:
+            if data['cv_url'] != user.worker_profile.cv_document and 'cv_summary' not in data:
+                # A different CV invalidates the old summary
+                user.worker_profile.cv_summary = None
             user.worker_profile.cv_document = data['cv_url']
         if 'cv_summary' in data:
             user.worker_profile.cv_summary = data['cv_summary']
@@ -160,14 +192,23 @@ def update_user_profile():
 def manage_availability():
     """Get or set worker availability"""
     user_id = get_jwt_identity()
-    user = User.query.get(user_id)
+    user = db.session.get(User, user_id)
 
     if not user or user.role != UserRole.WORKER:
         return jsonify({'error': 'Not a worker account'}), 403
 
     if request.method == 'GET':
-        # Get availability slots
-        availability = AvailabilitySlot.query.filter_by(
+        # Get availability slots (plain rows, no ORM instances)
+        availability = db.session.query(
+            AvailabilitySlot.id,
+            AvailabilitySlot.user_id,
+            AvailabilitySlot.date,
+            AvailabilitySlot.start_time,
+            AvailabilitySlot.end_time,
+            AvailabilitySlot.is_available,
+            AvailabilitySlot.reason,
+            AvailabilitySlot.is_recurring
+        ).filter_by(
             user_id=user_id
         ).all()
 
@@ -194,25 +235,23 @@ def manage_availability():
 
     date_obj = datetime.fromisoformat(date_str).date()
 
-    # Check if slot exists
-    slot = AvailabilitySlot.query.filter_by(
+    # Create or update the slot in one statement via the (user_id, date) constraint
+    stmt = insert(AvailabilitySlot).values(
         user_id=user_id,
-        date=date_obj
-    ).first()
-
-    if slot:
-        slot.is_available = is_available
-        slot.reason = data.get('reason')
-    else:
-        slot = AvailabilitySlot(
-            user_id=user_id,
-            date=date_obj,
-            is_available=is_available,
-            reason=data.get('reason'),
-            is_recurring=data.get('is_recurring', False)
-        )
-        db.session.add(slot)
+        date=date_obj,
+        is_available=is_available,
+        reason=data.get('reason'),
+        is_recurring=data.get('is_recurring', False)
+    )
+    stmt = stmt.on_conflict_do_update(
+        index_elements=['user_id', 'date'],
+        set_={
+            'is_available': stmt.excluded.is_available,
+            'reason': stmt.excluded.reason
+        }
+    ).returning(AvailabilitySlot.id, AvailabilitySlot.date, AvailabilitySlot.is_available)
 
+    slot = db.session.execute(stmt).one()
     db.session.commit()
 
     return jsonify({
@@ -234,7 +273,7 @@ def manage_availability():
 def get_referrals():
     """Get user's referrals"""
     user_id = get_jwt_identity()
-    user = User.query.get(user_id)
+    user = db.session.get(User, user_id)
 
     if not user or user.role != UserRole.WORKER:
         return jsonify({'error': 'Not a worker account'}), 403
@@ -262,7 +301,7 @@ def get_referrals():
 def refer_venue():
     """Refer a venue"""
     user_id = get_jwt_identity()
-    user = User.query.get(user_id)
+    user = db.session.get(User, user_id)
 
     if not user or user.role != UserRole.WORKER:
         return jsonify({'error': 'Not a worker account'}), 403
@@ -274,8 +313,10 @@ def refer_venue():
         return jsonify({'error': 'Missing required fields'}), 400
 
     # Check if venue email already exists
-    existing_venue = User.query.filter_by(email=data['manager_email']).first()
-    if existing_venue:
+    venue_exists = db.session.query(
+        User.query.filter_by(email=data['manager_email']).exists()
+    ).scalar()
+    if venue_exists:
         return jsonify({'error': 'This venue is already in our system'}), 409
 
     # Create pending referral (venue needs to accept within 7 days)
@@ -305,7 +346,7 @@ def refer_venue():
 def withdraw_referral_balance():
     """Withdraw referral earnings"""
     user_id = get_jwt_identity()
-    user = User.query.get(user_id)
+    user = db.session.get(User, user_id)
 
     if not user or user.role != UserRole.WORKER:
         return jsonify({'error': 'Not a worker account'}), 403
@@ -352,12 +393,11 @@ def withdraw_referral_balance():
 def manage_disputes():
     """Get disputes or create new dispute"""
     user_id = get_jwt_identity()
-    user = User.query.get(user_id)
 
     if request.method == 'GET':
         shift_id = request.args.get('shift_id', type=int)
 
-        query = Dispute.query.filter_by(reporter_id=user_id)
+        query = Dispute.query.options(raiseload('*')).filter_by(reporter_id=user_id)
         if shift_id:
             query = query.filter_by(shift_id=shift_id)
 
@@ -427,7 +467,7 @@ def manage_disputes():
 def create_boost_payment():
     """Create Stripe payment intent for shift boosting"""
     user_id = get_jwt_identity()
-    user = User.query.get(user_id)
+    user = db.session.get(User, user_id, options=[joinedload(User.venue_profile)])
 
     if not user or user.role != UserRole.VENUE:
         return jsonify({'error': 'Not a venue account'}), 403
@@ -439,7 +479,7 @@ def create_boost_payment():
     if not shift_id:
         return jsonify({'error': 'Shift ID required'}), 400
 
-    shift = Shift.query.get(shift_id)
+    shift = db.session.get(Shift, shift_id)
     if not shift or shift.venue_id != user.venue_profile.id:
         return jsonify({'error': 'Shift not found'}), 404
 
@@ -469,12 +509,12 @@ def create_boost_payment():
 def activate_shift_boost(shift_id):
     """Activate shift boost after payment"""
     user_id = get_jwt_identity()
-    user = User.query.get(user_id)
+    user = db.session.get(User, user_id, options=[joinedload(User.venue_profile)])
 
     if not user or user.role != UserRole.VENUE:
         return jsonify({'error': 'Not a venue account'}), 403
 
-    shift = Shift.query.get(shift_id)
+    shift = db.session.get(Shift, shift_id)
     if not shift or shift.venue_id != user.venue_profile.id:
         return jsonify({'error': 'Shift not found'}), 404
 
@@ -499,14 +539,20 @@ def activate_shift_boost(shift_id):
 def manage_venues():
     """Get venues or create new venue location"""
     user_id = get_jwt_identity()
-    user = User.query.get(user_id)
+    user = db.session.get(User, user_id, options=[joinedload(User.venue_profile)])
 
     if not user or user.role != UserRole.VENUE:
         return jsonify({'error': 'Not a venue account'}), 403
 
     if request.method == 'GET':
-        # Get all venues owned by this user
-        venues = VenueProfile.query.filter(
+        # Get all venues owned by this user (only the columns we return)
+        venues = db.session.query(
+            VenueProfile.id,
+            VenueProfile.venue_name,
+            VenueProfile.business_address,
+            VenueProfile.contact_phone,
+            VenueProfile.industry_type
+        ).filter(
             db.or_(
                 VenueProfile.user_id == user_id,
                 VenueProfile.parent_venue_id == user.venue_profile.id
@@ -551,13 +597,16 @@ def manage_venues():
 def get_team_members():
     """Get team members for venue"""
     user_id = get_jwt_identity()
-    user = User.query.get(user_id)
+    user = db.session.get(User, user_id, options=[joinedload(User.venue_profile)])
 
     if not user or user.role != UserRole.VENUE:
         return jsonify({'error': 'Not a venue account'}), 403
 
-    # Get all team members
-    team_members = VenueTeamMember.query.filter_by(
+    # Get all team members (with their user accounts in the same query)
+    team_members = VenueTeamMember.query.options(
+        joinedload(VenueTeamMember.user),
+        raiseload('*')
+    ).filter_by(
         venue_id=user.venue_profile.id
     ).all()
 
@@ -578,7 +627,7 @@ def get_team_members():
 def invite_team_member():
     """Invite team member to venue"""
     user_id = get_jwt_identity()
-    user = User.query.get(user_id)
+    user = db.session.get(User, user_id, options=[joinedload(User.venue_profile)])
 
     if not user or user.role != UserRole.VENUE:
         return jsonify({'error': 'Not a venue account'}), 403
@@ -606,7 +655,12 @@ def invite_team_member():
         status='pending'
     )
     db.session.add(team_member)
-    db.session.commit()
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # A concurrent invite for the same email won the unique constraint
+        db.session.rollback()
+        return jsonify({'error': 'User already invited'}), 409
 
     # TODO: Send invitation email
 
@@ -625,12 +679,12 @@ def invite_team_member():
 def get_smart_matches(shift_id):
     """Get smart-matched workers for a shift"""
     user_id = get_jwt_identity()
-    user = User.query.get(user_id)
+    user = db.session.get(User, user_id, options=[joinedload(User.venue_profile)])
 
     if not user or user.role != UserRole.VENUE:
         return jsonify({'error': 'Not a venue account'}), 403
 
-    shift = Shift.query.get(shift_id)
+    shift = db.session.get(Shift, shift_id)
     if not shift or shift.venue_id != user.venue_profile.id:
         return jsonify({'error': 'Shift not found'}), 404
 
@@ -641,13 +695,28 @@ def get_smart_matches(shift_id):
     # 3. Available on that date
     # 4. Within reasonable distance
 
-    workers = WorkerProfile.query.join(User).filter(
+    candidates = WorkerProfile.query.join(User).options(
+        contains_eager(WorkerProfile.user)
+    ).filter(
         User.is_active == True,
         User.is_suspended == False
-    ).all()
+    ).limit(10).all()  # Top 10 matches
+
+    # Accepted shifts at this venue for every candidate, in one grouped query
+    past_shift_counts = dict(
+        db.session.query(Application.worker_id, func.count(Application.id))
+        .join(Shift)
+        .filter(
+            Application.worker_id.in_([worker.id for worker in candidates]),
+            Application.status == ApplicationStatus.ACCEPTED,
+            Shift.venue_id == shift.venue_id
+        )
+        .group_by(Application.worker_id)
+        .all()
+    )
 
     matches = []
-    for worker in workers[:10]:  # Top 10 matches
+    for worker in candidates:
         # Calculate match score (simplified)
         match_score = 75.0  # Base score
         accept_likelihood = 65.0
@@ -659,10 +728,7 @@ def get_smart_matches(shift_id):
             match_reason += ", excellent reliability"
 
         # Boost if worked at this venue before
-        past_shifts = Application.query.filter_by(
-            worker_id=worker.id,
-            status=ApplicationStatus.ACCEPTED
-        ).join(Shift).filter(Shift.venue_id == shift.venue_id).count()
+        past_shifts = past_shift_counts.get(worker.id, 0)
 
         if past_shifts > 0:
             match_score += 10
@@ -696,12 +762,12 @@ def get_smart_matches(shift_id):
 def invite_worker_to_shift(shift_id):
     """Invite specific worker to a shift"""
     user_id = get_jwt_identity()
-    user = User.query.get(user_id)
+    user = db.session.get(User, user_id, options=[joinedload(User.venue_profile)])
 
     if not user or user.role != UserRole.VENUE:
         return jsonify({'error': 'Not a venue account'}), 403
 
-    shift = Shift.query.get(shift_id)
+    shift = db.session.get(Shift, shift_id)
     if not shift or shift.venue_id != user.venue_profile.id:
         return jsonify({'error': 'Shift not found'}), 404
 
@@ -711,7 +777,7 @@ def invite_worker_to_shift(shift_id):
     if not worker_id:
         return jsonify({'error': 'Worker ID required'}), 400
 
-    worker_user = User.query.get(worker_id)
+    worker_user = db.session.get(User, worker_id)
     if not worker_user or worker_user.role != UserRole.WORKER:
         return jsonify({'error': 'Worker not found'}), 404
 
@@ -740,7 +806,6 @@ def invite_worker_to_shift(shift_id):
 def create_rating():
     """Create a rating for a user"""
     user_id = get_jwt_identity()
-    user = User.query.get(user_id)
 
     data = request.get_json()
 
@@ -757,13 +822,15 @@ def create_rating():
         return jsonify({'error': 'Rating must be between 1 and 5'}), 400
 
     # Check if already rated
-    existing = Rating.query.filter_by(
-        shift_id=shift_id,
-        rater_id=user_id,
-        rated_user_id=rated_user_id
-    ).first()
+    already_rated = db.session.query(
+        Rating.query.filter_by(
+            shift_id=shift_id,
+            rater_id=user_id,
+            rated_user_id=rated_user_id
+        ).exists()
+    ).scalar()
 
-    if existing:
+    if already_rated:
         return jsonify({'error': 'Already rated this user for this shift'}), 409
 
     rating = Rating(
@@ -777,7 +844,7 @@ def create_rating():
     db.session.add(rating)
 
     # Update average rating for rated user
-    rated_user = User.query.get(rated_user_id)
+    rated_user = db.session.get(User, rated_user_id)
     if rated_user:
         avg_rating = db.session.query(func.avg(Rating.stars)).filter_by(
             rated_user_id=rated_user_id
@@ -800,11 +867,24 @@ def create_rating():
 @jwt_required()
 def get_user_ratings(user_id):
     """Get ratings for a user"""
-    ratings = Rating.query.filter_by(rated_user_id=user_id).order_by(
+    # Ratings are insert-only, so count + newest timestamp identifies the list
+    latest, total = db.session.query(
+        func.max(Rating.created_at),
+        func.count(Rating.id)
+    ).filter(Rating.rated_user_id == user_id).one()
+
+    etag = f"ratings-{user_id}-{total}-{latest.isoformat() if latest else 0}"
+    if request.if_none_match.contains_weak(etag):
+        response = app.response_class(status=304)
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'private, no-cache'
+        return response
+
+    ratings = Rating.query.options(raiseload('*')).filter_by(rated_user_id=user_id).order_by(
         Rating.created_at.desc()
     ).limit(50).all()
 
-    return jsonify({
+    response = jsonify({
         'ratings': [{
             'id': r.id,
             'shift_id': r.shift_id,
@@ -815,7 +895,11 @@ def get_user_ratings(user_id):
             'tags': r.tags,
             'created_at': r.created_at.isoformat()
         } for r in ratings]
-    }), 200
+    })
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache'
+
+    return response, 200
 
 
 # ===========================